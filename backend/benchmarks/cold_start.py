@@ -0,0 +1,62 @@
+"""
+Time from starting a backend process to its first successful request, which is what matters when
+containers are scaled up. Needs DATABASE_URL and UPLOADS_PATH like the app itself.
+
+    python -m benchmarks.cold_start [runs]
+"""
+
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+RUNS = 5
+TIMEOUT = 60
+POLL_INTERVAL = 0.01
+FIRST_REQUEST = "/api/v1/tags/list"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def cold_start() -> float:
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < TIMEOUT:
+            try:
+                response = httpx.get(f"http://127.0.0.1:{port}{FIRST_REQUEST}")
+                if response.status_code == 200:
+                    return time.perf_counter() - start
+            except httpx.TransportError:
+                pass
+            time.sleep(POLL_INTERVAL)
+        raise TimeoutError(f"no successful request after {TIMEOUT}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main() -> None:
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    timings = [cold_start() for _ in range(runs)]
+    print(
+        f"time to first successful request over {runs} runs:"
+        f" min {min(timings):.3f}s, median {statistics.median(timings):.3f}s,"
+        f" max {max(timings):.3f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
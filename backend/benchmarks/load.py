@@ -0,0 +1,56 @@
+"""
+Load generator reporting throughput, status codes and latency percentiles, to check that tail
+latency stays bounded when the backend is overloaded.
+
+    python -m benchmarks.load URL [concurrency] [seconds]
+"""
+
+import asyncio
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+CONCURRENCY = 64
+DURATION = 10
+
+
+async def worker(client: httpx.AsyncClient, url: str, deadline: float, results: list) -> None:
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            status_code = (await client.get(url)).status_code
+        except httpx.TransportError:
+            status_code = "error"
+        results.append((status_code, time.perf_counter() - start))
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def main() -> None:
+    url = sys.argv[1]
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else CONCURRENCY
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else DURATION
+
+    results = []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=None) as client:
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(worker(client, url, deadline, results) for _ in range(concurrency)))
+
+    print(
+        f"{len(results) / duration:,.0f} requests/s, status codes {dict(Counter(r[0] for r in results))}"
+    )
+    for status_code in sorted({r[0] for r in results}, key=str):
+        latencies = sorted(latency for code, latency in results if code == status_code)
+        print(
+            f"{status_code}: p50 {percentile(latencies, 0.5) * 1000:.1f}ms,"
+            f" p99 {percentile(latencies, 0.99) * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+"""
+Rows per second serialized for schemas.models.Image and Tag, through the response model like
+FastAPI does by default, and straight from row tuples with orjson like the list endpoints.
+
+    python -m benchmarks.serialization [rows]
+"""
+
+import json
+import os
+import sys
+import time
+import uuid
+
+import orjson
+
+os.environ.setdefault("DATABASE_URL", "postgresql+asyncpg://localhost/benchmark")
+os.environ.setdefault("UPLOADS_PATH", "/tmp")
+
+from database.models import Images
+from database.models import Tags
+from fastapi.encoders import jsonable_encoder
+from pydantic import parse_obj_as
+from schemas.models import Image
+from schemas.models import Tag
+from sqlalchemy.engine.result import result_tuple
+from utils.crud import IMAGE_COLUMNS
+from utils.crud import TAG_COLUMNS
+
+ROWS = 10000
+REPEAT = 5
+
+
+def rows_per_second(serialize, data) -> float:
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        serialize(data)
+        best = min(best, time.perf_counter() - start)
+    return len(data) / best
+
+
+def through_model(model):
+    def serialize(instances):
+        return json.dumps(jsonable_encoder(parse_obj_as(list[model], instances))).encode()
+
+    return serialize
+
+
+def from_rows(rows):
+    return orjson.dumps([row._asdict() for row in rows])
+
+
+def make_rows(columns, values) -> list:
+    make_row = result_tuple([column.key for column in columns])
+    return [make_row(row) for row in values]
+
+
+def main() -> None:
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else ROWS
+    images = [(uuid.uuid4(), f"{i}.jpg", "image/jpeg") for i in range(rows)]
+    tags = [(uuid.uuid4(), f"tag-{i}") for i in range(rows)]
+
+    cases = [
+        (
+            "Image",
+            [Images(id=i, filename=f, mime_type=m) for i, f, m in images],
+            make_rows(IMAGE_COLUMNS, images),
+        ),
+        ("Tag", [Tags(id=i, name=n) for i, n in tags], make_rows(TAG_COLUMNS, tags)),
+    ]
+    for name, instances, row_tuples in cases:
+        model = Image if name == "Image" else Tag
+        assert json.loads(through_model(model)(instances)) == json.loads(from_rows(row_tuples))
+        print(
+            f"{name}: response model {rows_per_second(through_model(model), instances):,.0f} rows/s,"
+            f" rows + orjson {rows_per_second(from_rows, row_tuples):,.0f} rows/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
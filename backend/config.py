@@ -1,12 +1,32 @@
-import os
 from functools import lru_cache
 
 from pydantic import BaseSettings
 
 
 class Settings(BaseSettings):
-    database_url: str = os.environ["DATABASE_URL"]
-    uploads_path: str = os.environ["UPLOADS_PATH"]
+    # Read from the environment on first use, so importing the app does not require them
+    database_url: str
+    uploads_path: str
+    database_replica_url: str | None = None
+    read_your_writes_seconds: float = 0.0
+    database_echo: bool = False
+    profile_header: str = "X-Profile"
+    # Requests are only profiled on demand when the header carries this token
+    profile_token: str | None = None
+    profile_sample_rate: float = 0.0
+    slow_query_ms: float = 100.0
+    # Longest prefix first: archives stream for long and get their own few slots
+    admission_concurrency: dict[str, int] = {
+        "/api/v1/images/create": 16,
+        "/view/images": 64,
+        "/view/images/archive": 4,
+    }
+    admission_queue_timeout: float = 1.0
+    rate_limit_per_second: float = 0.0
+    rate_limit_burst: int = 20
+    rate_limit_redis_url: str | None = None
+    max_event_loop_lag_ms: float = 500.0
+    max_pool_wait_ms: float = 1000.0
 
 
 @lru_cache()
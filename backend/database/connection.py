@@ -1,18 +1,109 @@
+import math
+import time
 from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from functools import lru_cache
 
 from config import get_settings
+from fastapi import Request
+from fastapi import Response
+from sqlalchemy.ext.asyncio import AsyncEngine
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker
+from utils.admission import pool_wait
+from utils.profiling import install_query_hooks
 
-__all__ = ["engine", "get_db"]
+__all__ = [
+    "get_engine",
+    "get_replica_engine",
+    "get_session_factory",
+    "get_replica_session_factory",
+    "get_db",
+    "get_read_db",
+]
 
-engine = create_async_engine(get_settings().database_url, future=True, echo=True)
-AsyncSessionFactory = sessionmaker(
-    bind=engine, autoflush=False, expire_on_commit=False, class_=AsyncSession
-)
+PRIMARY_PIN_COOKIE = "primary_until"
 
 
-async def get_db() -> AsyncGenerator:
-    async with AsyncSessionFactory() as session:
+def _create_engine(url: str) -> AsyncEngine:
+    engine = create_async_engine(url, future=True, echo=get_settings().database_echo)
+    install_query_hooks(engine)
+    return engine
+
+
+@lru_cache()
+def get_engine() -> AsyncEngine:
+    """
+    Create the engine on first use rather than at import time.
+    """
+    return _create_engine(get_settings().database_url)
+
+
+@lru_cache()
+def get_replica_engine() -> AsyncEngine:
+    """
+    Create the read replica engine on first use, or use the primary one if there is no replica.
+    """
+    if get_settings().database_replica_url is None:
+        return get_engine()
+    return _create_engine(get_settings().database_replica_url)
+
+
+@lru_cache()
+def get_session_factory() -> sessionmaker:
+    return sessionmaker(
+        bind=get_engine(), autoflush=False, expire_on_commit=False, class_=AsyncSession
+    )
+
+
+@lru_cache()
+def get_replica_session_factory() -> sessionmaker:
+    return sessionmaker(
+        bind=get_replica_engine(), autoflush=False, expire_on_commit=False, class_=AsyncSession
+    )
+
+
+@asynccontextmanager
+async def _open_session(session_factory: sessionmaker) -> AsyncGenerator:
+    async with session_factory() as session:
+        # Check out the connection upfront to measure the pool wait for admission control
+        start = time.perf_counter()
+        await session.connection()
+        pool_wait.observe(time.perf_counter() - start)
+        yield session
+
+
+async def get_db(response: Response) -> AsyncGenerator:
+    """
+    Session on the primary, for routes that write. With read-your-writes enabled, the client is
+    pinned to the primary for a while, so it reads its writes even if the replica lags behind.
+    """
+    window = get_settings().read_your_writes_seconds
+    if window > 0:
+        response.set_cookie(
+            PRIMARY_PIN_COOKIE, str(time.time() + window), max_age=math.ceil(window)
+        )
+
+    async with _open_session(get_session_factory()) as session:
+        yield session
+
+
+def _read_session_factory(request: Request) -> sessionmaker:
+    window = get_settings().read_your_writes_seconds
+    try:
+        # The cookie comes from the client, so only trust pins within the configured window
+        now = time.time()
+        if window > 0 and now < float(request.cookies.get(PRIMARY_PIN_COOKIE, 0)) <= now + window:
+            return get_session_factory()
+    except ValueError:
+        pass
+    return get_replica_session_factory()
+
+
+async def get_read_db(request: Request) -> AsyncGenerator:
+    """
+    Session on the read replica, or on the primary while the client is pinned to it.
+    """
+    async with _open_session(_read_session_factory(request)) as session:
         yield session
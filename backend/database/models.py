@@ -1,18 +1,40 @@
-import time
+import asyncio
 import uuid
 
+from asyncpg.exceptions import CannotConnectNowError
+from sqlalchemy import BigInteger
 from sqlalchemy import Column
+from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
+from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
 
-from .connection import engine
+from .connection import get_engine
 
-__all__ = ["Base", "Images", "Tags", "ImageTags", "init_models"]
+__all__ = [
+    "Base",
+    "Images",
+    "Tags",
+    "ImageTags",
+    "Albums",
+    "AlbumTags",
+    "AlbumImages",
+    "CatalogEvents",
+    "init_models",
+]
 
 CONNECT_TIMEOUT = 20
+CONNECT_BACKOFF_MIN = 0.05
+CONNECT_BACKOFF_MAX = 1
+# Arbitrary key of the advisory lock serializing schema changes of processes starting at once
+SCHEMA_LOCK_ID = 0x73636865
 
 Base = declarative_base()
 
@@ -25,6 +47,7 @@ class Images(Base):
     )
     filename = Column(String, nullable=False)
     mime_type = Column(String, nullable=False)
+    checksum = Column(String, nullable=True)
 
     tags = relationship("Tags", secondary="image_tags", back_populates="images", lazy="selectin")
 
@@ -47,11 +70,109 @@ class ImageTags(Base):
     tag_id = Column(UUID(as_uuid=True), ForeignKey("tags.id"), primary_key=True, nullable=False)
 
 
+class Albums(Base):
+    __tablename__ = "albums"
+
+    id = Column(
+        UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True, nullable=False
+    )
+    name = Column(String, nullable=False)
+    tag_count = Column(Integer, nullable=False)
+
+
+class AlbumTags(Base):
+    __tablename__ = "album_tags"
+
+    album_id = Column(UUID(as_uuid=True), ForeignKey("albums.id"), primary_key=True, nullable=False)
+    # Tags used by an album are kept even when no image has them anymore
+    tag_id = Column(
+        UUID(as_uuid=True), ForeignKey("tags.id"), primary_key=True, index=True, nullable=False
+    )
+
+
+class AlbumImages(Base):
+    __tablename__ = "album_images"
+
+    album_id = Column(UUID(as_uuid=True), ForeignKey("albums.id"), primary_key=True, nullable=False)
+    image_id = Column(
+        UUID(as_uuid=True), ForeignKey("images.id"), primary_key=True, index=True, nullable=False
+    )
+
+
+class CatalogEvents(Base):
+    __tablename__ = "catalog_events"
+
+    seq = Column(BigInteger, primary_key=True, autoincrement=True, nullable=False)
+    kind = Column(String, nullable=False)
+    # No foreign keys: events outlive the images, tags and albums they are about
+    image_id = Column(UUID(as_uuid=True), nullable=True)
+    tag_id = Column(UUID(as_uuid=True), nullable=True)
+    album_id = Column(UUID(as_uuid=True), nullable=True)
+    data = Column(JSONB, nullable=False, default=dict)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+def create_missing_tables(connection) -> None:
+    """
+    Create the missing tables, add the missing nullable columns and drop NOT NULL from the columns
+    made nullable, which takes two queries when the schema is current. Any other missing column can
+    not be added and fails loudly.
+    """
+    # Hold the lock until the end of the transaction, so other processes see the changes made
+    connection.execute(select(func.pg_advisory_xact_lock(SCHEMA_LOCK_ID)))
+    existing = {}
+    for table_name, column_name, is_nullable in connection.execute(
+        text(
+            "SELECT table_name, column_name, is_nullable FROM information_schema.columns"
+            " WHERE table_schema = current_schema()"
+        )
+    ):
+        existing.setdefault(table_name, {})[column_name] = is_nullable == "YES"
+
+    if not set(Base.metadata.tables).issubset(existing):
+        Base.metadata.create_all(connection)
+
+    preparer = connection.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        for column in table.columns:
+            if column.name in existing[table.name]:
+                if column.nullable and not existing[table.name][column.name]:
+                    connection.execute(
+                        text(
+                            f"ALTER TABLE {preparer.format_table(table)}"
+                            f" ALTER COLUMN {preparer.format_column(column)} DROP NOT NULL"
+                        )
+                    )
+                continue
+            if not column.nullable:
+                raise RuntimeError(
+                    f"Column {table.name}.{column.name} is missing and can not be added"
+                )
+            connection.execute(
+                text(
+                    f"ALTER TABLE {preparer.format_table(table)}"
+                    f" ADD COLUMN {preparer.format_column(column)}"
+                    f" {column.type.compile(dialect=connection.dialect)}"
+                )
+            )
+
+
 async def init_models() -> None:
-    for _ in range(CONNECT_TIMEOUT):
+    """
+    Create the tables, waiting with exponential backoff for the database to accept connections.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + CONNECT_TIMEOUT
+    delay = CONNECT_BACKOFF_MIN
+    while True:
         try:
-            async with engine.begin() as connection:
-                await connection.run_sync(Base.metadata.create_all)
+            async with get_engine().begin() as connection:
+                await connection.run_sync(create_missing_tables)
             return
-        except OSError:
-            time.sleep(1)
+        except (OSError, CannotConnectNowError):
+            if loop.time() + delay > deadline:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, CONNECT_BACKOFF_MAX)
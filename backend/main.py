@@ -2,8 +2,12 @@ import routes.api
 import routes.view
 from database.models import init_models
 from fastapi import FastAPI
+from utils.admission import AdmissionMiddleware
+from utils.profiling import ProfilingMiddleware
 
 app = FastAPI()
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(AdmissionMiddleware)
 app.include_router(router=routes.api.router, prefix="/api/v1")
 app.include_router(router=routes.view.router, prefix="/view")
 
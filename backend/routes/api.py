@@ -1,22 +1,43 @@
 from uuid import UUID
 
 import utils.crud
+import utils.events
+import utils.scrub
 from database.connection import get_db
+from database.connection import get_read_db
 from fastapi import APIRouter
 from fastapi import Depends
+from fastapi import Header
 from fastapi import UploadFile
 from fastapi import status
+from fastapi.responses import ORJSONResponse
+from fastapi.responses import StreamingResponse
 from schemas.models import AddTag
+from schemas.models import Album
+from schemas.models import CatalogEvent
+from schemas.models import CreateAlbum
 from schemas.models import Image
+from schemas.models import ImageIds
 from schemas.models import ImageMetadata
 from schemas.models import ReplaceTag
+from schemas.models import StorageReport
 from schemas.models import Tag
 from schemas.models import TagQuery
 from sqlalchemy.ext.asyncio import AsyncSession
+from utils.profiling import ProfiledRoute
+from utils.profiling import timed
 
 __all__ = ["router"]
 
-router = APIRouter(tags=["api"])
+router = APIRouter(tags=["api"], route_class=ProfiledRoute)
+
+
+def rows_response(rows: list) -> ORJSONResponse:
+    """
+    Encode rows straight to JSON, skipping the validation against the response model.
+    """
+    with timed("serialization"):
+        return ORJSONResponse([row._asdict() for row in rows])
 
 
 @router.post("/images/create", status_code=status.HTTP_201_CREATED, response_model=Image)
@@ -32,17 +53,26 @@ async def delete_image(image_id: UUID, db_session: AsyncSession = Depends(get_db
 
 
 @router.post("/images/search", status_code=status.HTTP_200_OK, response_model=list[Image])
-async def search_image(query: TagQuery, db_session: AsyncSession = Depends(get_db)):
-    return await utils.crud.search_image_by_tags(db_session, query)
+async def search_image(query: TagQuery, db_session: AsyncSession = Depends(get_read_db)):
+    return rows_response(await utils.crud.search_image_by_tags(db_session, query))
 
 
 @router.get("/images/list", status_code=status.HTTP_200_OK, response_model=list[Image])
-async def list_images(offset: int = 0, limit: int = 20, db_session: AsyncSession = Depends(get_db)):
-    return await utils.crud.list_image_by_limit(db_session, offset, limit)
+async def list_images(
+    offset: int = 0, limit: int = 20, db_session: AsyncSession = Depends(get_read_db)
+):
+    return rows_response(await utils.crud.list_image_by_limit(db_session, offset, limit))
+
+
+@router.post(
+    "/images/metadata", status_code=status.HTTP_200_OK, response_model=dict[UUID, ImageMetadata]
+)
+async def get_images_metadata(image_ids: ImageIds, db_session: AsyncSession = Depends(get_read_db)):
+    return await utils.crud.get_images_info_by_ids(db_session, image_ids.ids)
 
 
 @router.get("/images/{image_id}", status_code=status.HTTP_200_OK, response_model=ImageMetadata)
-async def get_image(image_id: UUID, db_session: AsyncSession = Depends(get_db)):
+async def get_image(image_id: UUID, db_session: AsyncSession = Depends(get_read_db)):
     return await utils.crud.get_image_info_by_id(db_session, image_id)
 
 
@@ -65,5 +95,51 @@ async def delete_tag_of_image(image_id: UUID, tag_id: UUID, db_session=Depends(g
 
 
 @router.get("/tags/list", status_code=status.HTTP_200_OK, response_model=list[Tag])
-async def list_tags(db_session: AsyncSession = Depends(get_db)):
-    return await utils.crud.list_tags(db_session)
+async def list_tags(db_session: AsyncSession = Depends(get_read_db)):
+    return rows_response(await utils.crud.list_tags(db_session))
+
+
+@router.post("/storage/scrub", status_code=status.HTTP_200_OK, response_model=StorageReport)
+async def scrub_storage(repair: bool = False, db_session: AsyncSession = Depends(get_db)):
+    # Hashing every file does not fit in a request, checksums are only verified by the CLI
+    return await utils.scrub.scrub_storage(db_session, repair, verify=False)
+
+
+@router.post("/albums/create", status_code=status.HTTP_201_CREATED, response_model=Album)
+async def create_album(album: CreateAlbum, db_session: AsyncSession = Depends(get_db)):
+    return await utils.crud.create_album(db_session, album)
+
+
+@router.get("/albums/list", status_code=status.HTTP_200_OK, response_model=list[Album])
+async def list_albums(db_session: AsyncSession = Depends(get_read_db)):
+    return await utils.crud.list_albums(db_session)
+
+
+@router.get("/albums/{album_id}/images", status_code=status.HTTP_200_OK, response_model=list[Image])
+async def list_album_images(
+    album_id: UUID,
+    offset: int = 0,
+    limit: int = 20,
+    db_session: AsyncSession = Depends(get_read_db),
+):
+    return rows_response(await utils.crud.list_album_images(db_session, album_id, offset, limit))
+
+
+@router.delete("/albums/{album_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_album(album_id: UUID, db_session: AsyncSession = Depends(get_db)):
+    await utils.crud.delete_album_by_id(db_session, album_id)
+    return None
+
+
+@router.get("/events", status_code=status.HTTP_200_OK, response_model=list[CatalogEvent])
+async def list_events(after: int = 0, limit: int = 100, wait: float = 0):
+    return rows_response(await utils.events.wait_for_events(after, limit, wait))
+
+
+@router.get("/events/stream", status_code=status.HTTP_200_OK)
+async def stream_events(after: int = 0, last_event_id: int | None = Header(None)):
+    return StreamingResponse(
+        utils.events.stream_events(after if last_event_id is None else last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,17 +1,25 @@
 from uuid import UUID
 
 import utils.crud
-from database.connection import get_db
+from database.connection import get_read_db
 from fastapi import APIRouter
 from fastapi import Depends
 from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
+from schemas.models import TagQuery
 from sqlalchemy.ext.asyncio import AsyncSession
+from utils.profiling import ProfiledRoute
 
 __all__ = ["router"]
 
-router = APIRouter(tags=["view"])
+router = APIRouter(tags=["view"], route_class=ProfiledRoute)
 
 
 @router.get("/images/{image_id}", response_class=FileResponse)
-async def get_image(image_id: UUID, db_session: AsyncSession = Depends(get_db)):
+async def get_image(image_id: UUID, db_session: AsyncSession = Depends(get_read_db)):
     return await utils.crud.get_image_response_by_id(db_session, image_id)
+
+
+@router.post("/images/archive", response_class=StreamingResponse)
+async def get_images_archive(query: TagQuery, db_session: AsyncSession = Depends(get_read_db)):
+    return await utils.crud.get_archive_response_by_tags(db_session, query)
@@ -1,6 +1,10 @@
+from datetime import datetime
 from uuid import UUID
 
 from pydantic import BaseModel
+from pydantic import conlist
+
+METADATA_BATCH_SIZE = 100
 
 
 class Image(BaseModel):
@@ -36,3 +40,39 @@ class TagQuery(BaseModel):
 class ImageMetadata(BaseModel):
     tags: list[Tag] = []
     filename: str
+
+
+class ImageIds(BaseModel):
+    ids: conlist(UUID, max_items=METADATA_BATCH_SIZE) = []
+
+
+class Album(BaseModel):
+    id: UUID
+    name: str
+
+    class Config:
+        orm_mode = True
+
+
+class CreateAlbum(BaseModel):
+    name: str
+    tags_id: list[UUID] = []
+
+
+class CatalogEvent(BaseModel):
+    seq: int
+    kind: str
+    image_id: UUID | None = None
+    tag_id: UUID | None = None
+    album_id: UUID | None = None
+    data: dict = {}
+    created_at: datetime
+
+
+class StorageReport(BaseModel):
+    scanned_files: int = 0
+    scanned_images: int = 0
+    missing_files: list[UUID] = []
+    orphan_files: list[str] = []
+    corrupt_files: list[UUID] = []
+    repaired: bool = False
@@ -1,6 +1,6 @@
 import pytest
 import pytest_asyncio
-from database.connection import engine
+from database.connection import get_engine
 from database.models import Base
 from httpx import AsyncClient
 from main import app
@@ -16,10 +16,10 @@ def anyio_backend(request):
 
 
 async def start_db():
-    async with engine.begin() as conn:
+    async with get_engine().begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)
-    await engine.dispose()
+    await get_engine().dispose()
 
 
 @pytest_asyncio.fixture
@@ -27,4 +27,4 @@ async def client() -> AsyncClient:
     async with AsyncClient(app=app, base_url="http://testserver/") as client:
         await start_db()
         yield client
-        await engine.dispose()
+        await get_engine().dispose()
@@ -1,10 +1,36 @@
+import asyncio
+import io
+import json
+import logging
 import os
+import time
+import zipfile
+from types import SimpleNamespace
 from uuid import UUID
 
 import pytest
+import routes.api
+import utils.scrub
+from config import get_settings
+from database.connection import _read_session_factory
+from database.connection import get_engine
+from database.connection import get_session_factory
+from database.models import create_missing_tables
+from fastapi import APIRouter
+from fastapi import FastAPI
+from fastapi import Request
 from fastapi import status
 from httpx import AsyncClient
 from httpx import Response
+from sqlalchemy import create_engine
+from sqlalchemy import text
+from sqlalchemy.engine.result import result_tuple
+from sqlalchemy.exc import DBAPIError
+from utils.admission import AdmissionMiddleware
+from utils.admission import ConcurrencyLimit
+from utils.profiling import ProfiledRoute
+from utils.profiling import ProfilingMiddleware
+from utils.profiling import install_query_hooks
 
 IMAGES_PATH = [
     "tests/images/a.jpg",
@@ -13,6 +39,8 @@ IMAGES_PATH = [
 
 BAD_TAG = "00000000-0000-0000-0000-000000000000"
 
+CONCURRENCY = 16
+
 pytestmark = pytest.mark.anyio
 
 
@@ -95,14 +123,92 @@ async def get_image_metadata(
     return response.json()
 
 
+async def get_images_metadata(
+    client: AsyncClient, image_ids: list, raw: bool = False
+) -> dict | Response:
+    response = await client.post("/api/v1/images/metadata", json={"ids": image_ids})
+    if raw:
+        return response
+    assert response.status_code == status.HTTP_200_OK
+    return response.json()
+
+
 async def search_images_by_tags(client: AsyncClient, tags: list) -> list:
     return (await client.post("/api/v1/images/search", json={"tags_id": tags})).json()
 
 
+async def download_archive(client: AsyncClient, tags: list) -> Response:
+    return await client.post("/view/images/archive", json={"tags_id": tags})
+
+
+async def scrub_storage(client: AsyncClient, repair: bool = False) -> dict:
+    response = await client.post("/api/v1/storage/scrub", params={"repair": repair})
+    assert response.status_code == status.HTTP_200_OK
+    return response.json()
+
+
+async def create_album(client: AsyncClient, name: str, tags: list) -> dict:
+    response = await client.post("/api/v1/albums/create", json={"name": name, "tags_id": tags})
+    assert response.status_code == status.HTTP_201_CREATED
+    assert UUID(response.json()["id"])
+    assert response.json()["name"] == name
+    return response.json()
+
+
+async def get_album_images(
+    client: AsyncClient, album_id: str, raw: bool = False
+) -> list | Response:
+    response = await client.get(f"/api/v1/albums/{album_id}/images")
+    if raw:
+        return response
+    assert response.status_code == status.HTTP_200_OK
+    return response.json()
+
+
+async def get_events(client: AsyncClient, after: int = 0, wait: float = 0) -> list:
+    response = await client.get("/api/v1/events", params={"after": after, "wait": wait})
+    assert response.status_code == status.HTTP_200_OK
+    return response.json()
+
+
+async def read_event_stream(count: int, after: int = 0, last_event_id: int = None) -> list:
+    response = await routes.api.stream_events(after=after, last_event_id=last_event_id)
+    assert response.media_type == "text/event-stream"
+    body = b""
+    try:
+        while body.count(b"\n\n") < count:
+            body += await anext(response.body_iterator)
+    finally:
+        await response.body_iterator.aclose()
+    return [
+        dict(line.split(": ", 1) for line in frame.split("\n"))
+        for frame in body.decode().split("\n\n")[:count]
+    ]
+
+
 async def test_health(client: AsyncClient):
     assert (await client.get("/")).status_code == status.HTTP_200_OK
 
 
+async def test_create_missing_columns(client: AsyncClient):
+    async def migrate():
+        async with get_engine().begin() as connection:
+            await connection.run_sync(create_missing_tables)
+
+    # nullable columns added since the tables were created are added, once by many processes
+    async with get_engine().begin() as connection:
+        await connection.execute(text("ALTER TABLE images DROP COLUMN checksum"))
+    await asyncio.gather(*(migrate() for _ in range(4)))
+    image = await create_image(client, IMAGES_PATH[0])
+    assert (await get_image_metadata(client, image["id"]))["filename"] == image["filename"]
+
+    # others fail loudly
+    async with get_engine().begin() as connection:
+        await connection.execute(text("ALTER TABLE images DROP COLUMN mime_type"))
+        with pytest.raises(RuntimeError):
+            await connection.run_sync(create_missing_tables)
+
+
 async def test_create_and_delete_and_view_image(client: AsyncClient):
     image_path = IMAGES_PATH[0]
 
@@ -375,6 +481,29 @@ async def test_image_data_fail_gracefully(client: AsyncClient):
     ).status_code == status.HTTP_404_NOT_FOUND
 
 
+async def test_get_images_metadata(client: AsyncClient):
+    # create images
+    image_a = await create_image(client, IMAGES_PATH[0])
+    image_b = await create_image(client, IMAGES_PATH[1])
+    tag_a = await add_tag_to_image(client, image_a["id"], "a")
+    tag_b = await add_tag_to_image(client, image_a["id"], "b")
+
+    # get metadata of both images and an unknown one
+    metadata = await get_images_metadata(client, [image_a["id"], image_b["id"], BAD_TAG])
+    assert len(metadata) == 2
+    assert metadata[image_a["id"]]["filename"] == image_a["filename"]
+    tags = metadata[image_a["id"]]["tags"]
+    assert len(tags) == 2 and tag_a in tags and tag_b in tags
+    assert metadata[image_b["id"]] == {"filename": image_b["filename"], "tags": []}
+
+    # same as single image metadata
+    assert metadata[image_a["id"]] == await get_image_metadata(client, image_a["id"])
+
+    # too many images
+    response = await get_images_metadata(client, [BAD_TAG] * 101, raw=True)
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
 async def test_search_image(client: AsyncClient):
     # create image a
     image_a = await create_image(client, IMAGES_PATH[0])
@@ -417,3 +546,460 @@ async def test_search_image(client: AsyncClient):
     # search images by tag a and tag b and tag c
     images = await search_images_by_tags(client, [tag_a["id"], tag_b["id"], tag_c["id"]])
     assert len(images) == 0
+
+
+async def test_download_archive(client: AsyncClient):
+    # create images
+    images = []
+    for image_path in IMAGES_PATH:
+        images.append(await create_image(client, image_path))
+
+    # add tag a to both images, tag b to image[0]
+    tag_a = await add_tag_to_image(client, images[0]["id"], "a")
+    await add_tag_to_image(client, images[1]["id"], "a")
+    tag_b = await add_tag_to_image(client, images[0]["id"], "b")
+
+    # download images with tag a
+    response = await download_archive(client, [tag_a["id"]])
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+        assert len(archive.namelist()) == 2
+        for image, image_path in zip(images, IMAGES_PATH):
+            with open(image_path, "rb") as f:
+                assert archive.read(f"{image['id']}-{image['filename']}") == f.read()
+
+    # download images with tag a and tag b
+    response = await download_archive(client, [tag_a["id"], tag_b["id"]])
+    with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+        assert archive.namelist() == [f"{images[0]['id']}-{images[0]['filename']}"]
+
+    # download images with unknown tag
+    response = await download_archive(client, [BAD_TAG])
+    with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+        assert len(archive.namelist()) == 0
+
+
+async def test_scrub_storage(client: AsyncClient):
+    uploads_path = get_settings().uploads_path
+
+    # create images
+    images = []
+    for image_path in IMAGES_PATH:
+        images.append(await create_image(client, image_path))
+    tag_a = await add_tag_to_image(client, images[0]["id"], "a")
+    await add_tag_to_image(client, images[1]["id"], "b")
+
+    # consistent storage
+    report = await scrub_storage(client)
+    assert report["scanned_images"] == 2
+    assert not report["missing_files"] and not report["corrupt_files"]
+
+    # remove the file of image[1], corrupt image[0] and add a file without row
+    os.remove(os.path.join(uploads_path, images[1]["id"]))
+    with open(os.path.join(uploads_path, images[0]["id"]), "ab") as f:
+        f.write(b"garbage")
+    with open(os.path.join(uploads_path, BAD_TAG), "wb") as f:
+        f.write(b"orphan")
+
+    # view image without file
+    response = await view_raw_image(client, images[1]["id"])
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    # report, checksums are only verified outside of the API
+    report = await scrub_storage(client)
+    assert report["missing_files"] == [images[1]["id"]]
+    assert not report["corrupt_files"]
+    assert report["orphan_files"] == [BAD_TAG]
+    assert os.path.exists(os.path.join(uploads_path, BAD_TAG))
+    async with get_session_factory()() as session:
+        report = await utils.scrub.scrub_storage(session)
+    assert report.corrupt_files == [UUID(images[0]["id"])]
+
+    # repair
+    report = await scrub_storage(client, repair=True)
+    assert report["repaired"]
+    assert not os.path.exists(os.path.join(uploads_path, BAD_TAG))
+    assert (await get_image_metadata(client, images[1]["id"], raw=True)).status_code == 404
+    assert await get_tags_list(client) == [tag_a]
+
+    # corrupt files are only reported
+    async with get_session_factory()() as session:
+        report = await utils.scrub.scrub_storage(session, repair=True)
+    assert not report.missing_files and not report.orphan_files
+    assert report.corrupt_files == [UUID(images[0]["id"])]
+
+    # delete image whose file is gone
+    os.remove(os.path.join(uploads_path, images[0]["id"]))
+    response = await delete_image(client, images[0]["id"])
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+
+    # each deleted image is logged once, even if the scrubber saw it missing
+    async with get_session_factory()() as session:
+        assert await utils.scrub._delete_images(session, [UUID(images[0]["id"])]) == []
+    events = await get_events(client)
+    deleted = [event["image_id"] for event in events if event["kind"] == "image_deleted"]
+    assert deleted == [images[1]["id"], images[0]["id"]]
+
+
+async def test_albums(client: AsyncClient):
+    # create images
+    image_a = await create_image(client, IMAGES_PATH[0])
+    image_b = await create_image(client, IMAGES_PATH[1])
+    tag_a = await add_tag_to_image(client, image_a["id"], "a")
+    tag_b = await add_tag_to_image(client, image_a["id"], "b")
+    await add_tag_to_image(client, image_b["id"], "a")
+
+    # create albums, membership is computed from existing tags
+    album_a = await create_album(client, "a", [tag_a["id"]])
+    album_ab = await create_album(client, "ab", [tag_a["id"], tag_b["id"]])
+    albums = (await client.get("/api/v1/albums/list")).json()
+    assert len(albums) == 2 and album_a in albums and album_ab in albums
+    images = await get_album_images(client, album_a["id"])
+    assert len(images) == 2 and image_a in images and image_b in images
+    assert await get_album_images(client, album_ab["id"]) == [image_a]
+
+    # add tag b to image b
+    await add_tag_to_image(client, image_b["id"], "b")
+    images = await get_album_images(client, album_ab["id"])
+    assert len(images) == 2 and image_a in images and image_b in images
+
+    # replace tag b of image a with tag c
+    await replace_tag_of_image(client, image_a["id"], tag_b["id"], "c")
+    assert await get_album_images(client, album_ab["id"]) == [image_b]
+
+    # delete tag a of image b
+    response = await delete_tag_of_image(client, image_b["id"], tag_a["id"])
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    assert await get_album_images(client, album_a["id"]) == [image_a]
+    assert await get_album_images(client, album_ab["id"]) == []
+
+    # delete image a
+    response = await delete_image(client, image_a["id"])
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    assert await get_album_images(client, album_a["id"]) == []
+
+    # tag a is kept for the album while no image has it, and matches again once re-added
+    assert tag_a in await get_tags_list(client)
+    assert await add_tag_to_image(client, image_b["id"], "a") == tag_a
+    assert await get_album_images(client, album_a["id"]) == [image_b]
+    assert await get_album_images(client, album_ab["id"]) == [image_b]
+
+    # delete album, with the tags only the album used
+    response = await delete_tag_of_image(client, image_b["id"], tag_a["id"])
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    response = await client.delete(f"/api/v1/albums/{album_a['id']}")
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    response = await get_album_images(client, album_a["id"], raw=True)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    response = await client.delete(f"/api/v1/albums/{album_a['id']}")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert tag_a in await get_tags_list(client)
+    response = await client.delete(f"/api/v1/albums/{album_ab['id']}")
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    assert await get_tags_list(client) == [tag_b]
+
+    # albums need known tags
+    response = await client.post("/api/v1/albums/create", json={"name": "none", "tags_id": []})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = await client.post(
+        "/api/v1/albums/create", json={"name": "bad", "tags_id": [BAD_TAG]}
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+async def test_add_tags_concurrently(client: AsyncClient):
+    images = []
+    for _ in range(CONCURRENCY):
+        images.append(await create_image(client, IMAGES_PATH[0]))
+
+    # add the same new tag to every image at once
+    responses = await asyncio.gather(
+        *(add_tag_to_image(client, image["id"], "a", raw=True) for image in images)
+    )
+    assert all(response.status_code == status.HTTP_201_CREATED for response in responses)
+    assert len({response.json()["id"] for response in responses}) == 1
+    tags = await get_tags_list(client)
+    assert len(tags) == 1 and tags[0] == responses[0].json()
+
+    # add the same new tag to the same image at once
+    responses = await asyncio.gather(
+        *(add_tag_to_image(client, images[0]["id"], "b", raw=True) for _ in range(CONCURRENCY))
+    )
+    status_codes = [response.status_code for response in responses]
+    assert status_codes.count(status.HTTP_201_CREATED) == 1
+    assert status_codes.count(status.HTTP_400_BAD_REQUEST) == CONCURRENCY - 1
+
+    # replace tag a with tag c on every image at once
+    tag_a = tags[0]
+    responses = await asyncio.gather(
+        *(replace_tag_of_image(client, image["id"], tag_a["id"], "c", raw=True) for image in images)
+    )
+    assert all(response.status_code == status.HTTP_200_OK for response in responses)
+    assert len({response.json()["id"] for response in responses}) == 1
+    tags = await get_tags_list(client)
+    assert len(tags) == 2 and tag_a not in tags
+
+    # replace tag b with tag c and tag c with tag b on different images at once
+    tag_b, tag_c = sorted(tags, key=lambda tag: tag["name"])
+    half = CONCURRENCY // 2
+    for image in images[1:half]:
+        await add_tag_to_image(client, image["id"], "b")
+    for image in images[:half]:
+        await delete_tag_of_image(client, image["id"], tag_c["id"])
+    responses = await asyncio.gather(
+        *(
+            replace_tag_of_image(client, image["id"], tag_b["id"], "c", raw=True)
+            for image in images[:half]
+        ),
+        *(
+            replace_tag_of_image(client, image["id"], tag_c["id"], "b", raw=True)
+            for image in images[half:]
+        ),
+    )
+    assert all(response.status_code == status.HTTP_200_OK for response in responses)
+    assert sorted(await get_tags_list(client), key=lambda tag: tag["name"]) == [tag_b, tag_c]
+
+
+async def test_profiling(client: AsyncClient, monkeypatch):
+    image = await create_image(client, IMAGES_PATH[0])
+
+    # requests are not profiled by default
+    response = await client.get(f"/api/v1/images/{image['id']}")
+    assert "server-timing" not in response.headers
+
+    # nor with the header but without the configured token
+    response = await client.get(f"/api/v1/images/{image['id']}", headers={"X-Profile": "1"})
+    assert "server-timing" not in response.headers
+    monkeypatch.setattr(get_settings(), "profile_token", "secret")
+    response = await client.get(f"/api/v1/images/{image['id']}", headers={"X-Profile": "1"})
+    assert "server-timing" not in response.headers
+
+    # profiled requests get a breakdown
+    response = await client.get(f"/api/v1/images/{image['id']}", headers={"X-Profile": "secret"})
+    assert response.status_code == status.HTTP_200_OK
+    sections = [timing.split(";")[0] for timing in response.headers["server-timing"].split(", ")]
+    assert "db" in sections and "serialization" in sections
+
+
+async def test_profiling_log(caplog, monkeypatch):
+    make_row = result_tuple(["id", "name"])
+    router = APIRouter(route_class=ProfiledRoute)
+
+    @router.get("/rows")
+    async def rows():
+        return routes.api.rows_response([make_row((i, f"tag-{i}")) for i in range(1000)])
+
+    app = FastAPI()
+    app.add_middleware(ProfilingMiddleware)
+    app.include_router(router)
+
+    # the header is ignored without the configured token
+    async with AsyncClient(app=app, base_url="http://testserver/") as client:
+        response = await client.get("/rows", headers={"X-Profile": "1"})
+    assert "server-timing" not in response.headers
+    assert not [record for record in caplog.records if record.name == "profiling"]
+
+    # profiles are logged without any logging configuration, encoding included
+    monkeypatch.setattr(get_settings(), "profile_token", "secret")
+    async with AsyncClient(app=app, base_url="http://testserver/") as client:
+        response = await client.get("/rows", headers={"X-Profile": "secret"})
+    assert "server-timing" in response.headers
+    assert response.status_code == status.HTTP_200_OK
+    assert logging.getLogger("profiling").handlers
+    records = [record for record in caplog.records if record.name == "profiling"]
+    assert len(records) == 1
+    profile = json.loads(records[0].getMessage())
+    assert profile["path"] == "/rows"
+    assert profile["timings_ms"]["serialization"] > 0
+    assert profile["timings_ms"]["endpoint"] >= 0
+
+
+async def test_profiling_failed_statements():
+    # the hooks only use the sync engine, which runs the same events
+    engine = create_engine("sqlite://")
+    install_query_hooks(SimpleNamespace(sync_engine=engine))
+
+    # failed statements do not leave their start time on the connection
+    with engine.connect() as connection:
+        for _ in range(3):
+            with pytest.raises(DBAPIError):
+                connection.execute(text("SELECT * FROM missing"))
+        connection.execute(text("SELECT 1"))
+        assert connection.info["query_start_time"] == []
+
+
+async def test_admission_control():
+    async def slow():
+        await asyncio.sleep(0.05)
+
+    # at most 2 concurrent requests, waiting at most 0.1s for a slot
+    app = FastAPI()
+    app.get("/slow")(slow)
+    app.add_middleware(AdmissionMiddleware, concurrency={"/slow": 2}, queue_timeout=0.1, rate=0)
+
+    async def get_slow(client: AsyncClient) -> tuple[int, float]:
+        start = time.perf_counter()
+        response = await client.get("/slow")
+        return response.status_code, time.perf_counter() - start
+
+    async with AsyncClient(app=app, base_url="http://testserver/") as client:
+        results = await asyncio.gather(*(get_slow(client) for _ in range(CONCURRENCY)))
+    status_codes = [status_code for status_code, _ in results]
+    assert status_codes.count(status.HTTP_200_OK) >= 2
+    assert status_codes.count(status.HTTP_503_SERVICE_UNAVAILABLE) > 0
+    # overload is shed instead of queueing
+    assert max(latency for _, latency in results) < 1
+
+    # 1 request per second with bursts of 2
+    app = FastAPI()
+    app.get("/slow")(slow)
+    app.add_middleware(AdmissionMiddleware, concurrency={}, rate=1, burst=2)
+
+    async with AsyncClient(app=app, base_url="http://testserver/") as client:
+        status_codes = [(await client.get("/slow")).status_code for _ in range(3)]
+        assert status_codes == [200, 200, status.HTTP_429_TOO_MANY_REQUESTS]
+        response = await client.get("/slow", headers={"X-Real-IP": "10.0.0.1"})
+        assert response.status_code == status.HTTP_200_OK
+
+    # by default, archive downloads do not take the slots of image views
+    middleware = AdmissionMiddleware(app)
+    archive_limit = middleware.limit_for("/view/images/archive")
+    view_limit = middleware.limit_for(f"/view/images/{BAD_TAG}")
+    assert archive_limit is not view_limit and archive_limit.limit < view_limit.limit
+
+
+async def test_concurrency_limit_cancelled_waiters():
+    limit = ConcurrencyLimit(1)
+    assert await limit.acquire(1)
+
+    # a waiter cancelled while queued does not take the slot
+    waiter = asyncio.create_task(limit.acquire(10))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    limit.release()
+    assert limit.active == 0
+
+    # nor does a waiter cancelled right after the slot was handed over, unless it keeps the slot
+    assert await limit.acquire(1)
+    waiter = asyncio.create_task(limit.acquire(10))
+    await asyncio.sleep(0)
+    limit.release()
+    waiter.cancel()
+    try:
+        assert await waiter
+        limit.release()
+    except asyncio.CancelledError:
+        pass
+    assert limit.active == 0
+    assert await limit.acquire(0.2)
+
+
+async def test_read_your_writes(client: AsyncClient, monkeypatch):
+    # writes do not pin the client by default
+    image = await create_image(client, IMAGES_PATH[0], raw=True)
+    assert "primary_until" not in image.cookies
+
+    # writes pin the client to the primary
+    monkeypatch.setattr(get_settings(), "read_your_writes_seconds", 5)
+    image = (await create_image(client, IMAGES_PATH[0], raw=True)).json()
+    assert "primary_until" in client.cookies
+    metadata = await get_image_metadata(client, image["id"])
+    assert metadata["filename"] == image["filename"]
+
+    # failed writes do not
+    client.cookies.clear()
+    response = await delete_image(client, BAD_TAG)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert "primary_until" not in client.cookies
+
+
+async def test_read_your_writes_pin(monkeypatch):
+    def pinned(primary_until: float) -> bool:
+        cookie = f"primary_until={primary_until}".encode()
+        request = Request({"type": "http", "headers": [(b"cookie", cookie)]})
+        return _read_session_factory(request) is get_session_factory()
+
+    # pins are ignored when read-your-writes is disabled
+    assert not pinned(time.time() + 1)
+
+    # and honored only within the window
+    monkeypatch.setattr(get_settings(), "read_your_writes_seconds", 5)
+    assert pinned(time.time() + 1)
+    assert not pinned(time.time() - 1)
+    assert not pinned(1e18)
+
+
+async def test_events(client: AsyncClient):
+    # every mutation is logged in order
+    image = await create_image(client, IMAGES_PATH[0])
+    tag_a = await add_tag_to_image(client, image["id"], "a")
+    tag_b = await replace_tag_of_image(client, image["id"], tag_a["id"], "b")
+    await delete_tag_of_image(client, image["id"], tag_b["id"])
+    await delete_image(client, image["id"])
+    events = await get_events(client)
+    assert [event["seq"] for event in events] == [1, 2, 3, 4, 5, 6]
+    assert [(event["kind"], event["tag_id"]) for event in events] == [
+        ("image_created", None),
+        ("tag_added", tag_a["id"]),
+        ("tag_removed", tag_a["id"]),
+        ("tag_added", tag_b["id"]),
+        ("tag_removed", tag_b["id"]),
+        ("image_deleted", None),
+    ]
+    assert all(event["image_id"] == image["id"] for event in events)
+    assert events[0]["data"] == {"filename": "a.jpg", "mime_type": "image/jpeg"}
+    assert events[1]["data"] == {"name": "a"}
+
+    # failed mutations are not
+    response = await delete_image(client, image["id"])
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert await get_events(client, after=6) == []
+
+    # the limit is clamped
+    response = await client.get("/api/v1/events", params={"limit": -1})
+    assert response.status_code == status.HTTP_200_OK
+    assert [event["seq"] for event in response.json()] == [1]
+
+    # long polling returns as soon as an event is logged
+    poll = asyncio.create_task(get_events(client, after=6, wait=10))
+    await asyncio.sleep(0.1)
+    assert not poll.done()
+    image = await create_image(client, IMAGES_PATH[1])
+    events = await poll
+    assert [(event["seq"], event["image_id"]) for event in events] == [(7, image["id"])]
+
+    # album changes are logged too
+    tag = await add_tag_to_image(client, image["id"], "a")
+    album = await create_album(client, "a", [tag["id"]])
+    response = await client.delete(f"/api/v1/albums/{album['id']}")
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    events = await get_events(client, after=8)
+    assert [(event["kind"], event["album_id"]) for event in events] == [
+        ("album_created", album["id"]),
+        ("album_deleted", album["id"]),
+    ]
+    assert events[0]["image_id"] is None
+    assert events[0]["data"] == {"name": "a", "tags_id": [tag["id"]]}
+
+
+async def test_event_stream(client: AsyncClient):
+    image = await create_image(client, IMAGES_PATH[0])
+    tag = await add_tag_to_image(client, image["id"], "a")
+
+    # events are framed with their sequence number as id
+    frames = await read_event_stream(2)
+    assert [(frame["id"], frame["event"]) for frame in frames] == [
+        ("1", "image_created"),
+        ("2", "tag_added"),
+    ]
+    data = json.loads(frames[1]["data"])
+    assert data["seq"] == 2 and data["image_id"] == image["id"] and data["tag_id"] == tag["id"]
+
+    # clients start after the query cursor, and resume after the Last-Event-ID header
+    frames = await read_event_stream(1, after=1)
+    assert frames[0]["id"] == "2"
+    frames = await read_event_stream(1, after=2, last_event_id=1)
+    assert frames[0]["id"] == "2"
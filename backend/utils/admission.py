@@ -0,0 +1,267 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from collections import deque
+
+from config import get_settings
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+__all__ = ["AdmissionMiddleware", "pool_wait"]
+
+EXEMPT_PATHS = ["/"]
+CLIENT_HEADER = "X-Real-IP"
+MAX_CLIENTS = 100000
+LAG_INTERVAL = 0.05
+
+
+class DecayingPeak:
+    """
+    Recent peak of a measurement, halving every `half_life` seconds without new observations.
+    """
+
+    def __init__(self, half_life: float = 1.0) -> None:
+        self.half_life = half_life
+        self._value = 0.0
+        self._time = time.monotonic()
+
+    def get(self) -> float:
+        return self._value * 0.5 ** ((time.monotonic() - self._time) / self.half_life)
+
+    def observe(self, value: float) -> None:
+        self._value = max(value, self.get())
+        self._time = time.monotonic()
+
+
+# Time spent waiting for a database connection, fed by database.connection.get_db
+pool_wait = DecayingPeak()
+
+
+class EventLoopLag(DecayingPeak):
+    """
+    How late a periodic sleep wakes up, measured by a task on the running event loop.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._loop = None
+        self._task = None
+
+    def ensure_started(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._task = loop.create_task(self._measure(loop))
+
+    async def _measure(self, loop) -> None:
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.observe(loop.time() - start - LAG_INTERVAL)
+
+
+class ConcurrencyLimit:
+    """
+    Limit of concurrent requests, with first come first served waiting. Not bound to an event loop.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    async def acquire(self, timeout: float) -> bool:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            # The slot may have been handed over right when the timeout fired
+            if waiter.done():
+                return True
+            self._waiters.remove(waiter)
+            waiter.cancel()
+            return False
+        except asyncio.CancelledError:
+            # Pass on a slot handed over right before the cancellation, or stop waiting for one
+            if waiter.done():
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+                waiter.cancel()
+            raise
+        return True
+
+    def release(self) -> None:
+        # Hand the slot over to the next waiter, if any
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class TokenBucketLimiter:
+    """
+    In-process token bucket per client, keeping the most recently seen clients.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    async def allow(self, client: str) -> bool:
+        now = time.monotonic()
+        tokens, last = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= 1
+        self._buckets[client] = (tokens - 1 if allowed else tokens, now)
+        if len(self._buckets) > MAX_CLIENTS:
+            self._buckets.popitem(last=False)
+        return allowed
+
+
+class RedisTokenBucketLimiter:
+    """
+    Token bucket per client shared by every process through Redis.
+    """
+
+    SCRIPT = """
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local state = redis.call("HMGET", KEYS[1], "tokens", "time")
+    local tokens = tonumber(state[1]) or burst
+    tokens = math.min(burst, tokens + (now - (tonumber(state[2]) or now)) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call("HSET", KEYS[1], "tokens", tokens, "time", now)
+    redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+    return allowed
+    """
+
+    def __init__(self, url: str, rate: float, burst: int) -> None:
+        if redis is None:
+            raise RuntimeError("redis is required for a shared rate limit backend")
+        self.rate = rate
+        self.burst = burst
+        self._script = redis.from_url(url).register_script(self.SCRIPT)
+
+    async def allow(self, client: str) -> bool:
+        args = [self.rate, self.burst, time.time()]
+        return bool(await self._script(keys=[f"rate_limit:{client}"], args=args))
+
+
+class AdmissionMiddleware:
+    """
+    Admission control in front of the app. In order, requests are rejected with:
+    - 429 when the client ran out of rate limit tokens,
+    - 503 when the event loop lag or the database pool wait is over its threshold,
+    - 503 when the route stays at its concurrency limit for longer than the queue timeout.
+    Settings are used for the arguments not given.
+    """
+
+    def __init__(
+        self,
+        app,
+        concurrency: dict[str, int] | None = None,
+        queue_timeout: float | None = None,
+        rate: float | None = None,
+        burst: int | None = None,
+        max_loop_lag_ms: float | None = None,
+        max_pool_wait_ms: float | None = None,
+    ) -> None:
+        settings = get_settings()
+        self.app = app
+        self.queue_timeout = (
+            settings.admission_queue_timeout if queue_timeout is None else queue_timeout
+        )
+        self.max_loop_lag_ms = (
+            settings.max_event_loop_lag_ms if max_loop_lag_ms is None else max_loop_lag_ms
+        )
+        self.max_pool_wait_ms = (
+            settings.max_pool_wait_ms if max_pool_wait_ms is None else max_pool_wait_ms
+        )
+        self.loop_lag = EventLoopLag()
+
+        concurrency = settings.admission_concurrency if concurrency is None else concurrency
+        # Longest prefix first, so the most specific limit applies
+        self.limits = {
+            prefix: ConcurrencyLimit(limit)
+            for prefix, limit in sorted(concurrency.items(), key=lambda item: -len(item[0]))
+        }
+
+        rate = settings.rate_limit_per_second if rate is None else rate
+        burst = settings.rate_limit_burst if burst is None else burst
+        self.retry_after = str(math.ceil(1 / rate)) if rate else None
+        if not rate:
+            self.limiter = None
+        elif settings.rate_limit_redis_url:
+            self.limiter = RedisTokenBucketLimiter(settings.rate_limit_redis_url, rate, burst)
+        else:
+            self.limiter = TokenBucketLimiter(rate, burst)
+
+    def limit_for(self, path: str) -> ConcurrencyLimit | None:
+        return next(
+            (limit for prefix, limit in self.limits.items() if path.startswith(prefix)), None
+        )
+
+    def overloaded(self) -> bool:
+        lag_ms = self.loop_lag.get() * 1000
+        pool_wait_ms = pool_wait.get() * 1000
+        return bool(
+            (self.max_loop_lag_ms and lag_ms > self.max_loop_lag_ms)
+            or (self.max_pool_wait_ms and pool_wait_ms > self.max_pool_wait_ms)
+        )
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        self.loop_lag.ensure_started()
+
+        if self.limiter is not None:
+            client = Headers(scope=scope).get(CLIENT_HEADER) or (scope.get("client") or ("",))[0]
+            if not await self.limiter.allow(client):
+                response = JSONResponse(
+                    {"detail": "Too many requests"},
+                    status_code=429,
+                    headers={"Retry-After": self.retry_after},
+                )
+                await response(scope, receive, send)
+                return
+
+        if self.overloaded():
+            await self.unavailable(scope, receive, send)
+            return
+
+        limit = self.limit_for(scope["path"])
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        if not await limit.acquire(self.queue_timeout):
+            await self.unavailable(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limit.release()
+
+    async def unavailable(self, scope, receive, send) -> None:
+        response = JSONResponse(
+            {"detail": "Service overloaded"}, status_code=503, headers={"Retry-After": "1"}
+        )
+        await response(scope, receive, send)
@@ -0,0 +1,96 @@
+import asyncio
+import io
+import os
+import time
+import zipfile
+from collections.abc import AsyncGenerator
+from collections.abc import Generator
+from collections.abc import Iterable
+
+from starlette.concurrency import run_in_threadpool
+from utils.profiling import timed
+
+__all__ = ["stream_zip"]
+
+CHUNK_SIZE = 1024 * 1024
+READ_AHEAD = 4
+
+_END = object()
+
+
+class _ZipSink(io.RawIOBase):
+    """
+    Unseekable file object collecting what ZipFile writes, so it can be drained chunk by chunk.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(entries: Iterable[tuple[str, str]], chunk_size: int = CHUNK_SIZE) -> Generator:
+    """
+    Build a store-only ZIP archive from (arcname, path) pairs and yield it in chunks.
+    Files that no longer exist on disk are skipped.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for arcname, path in entries:
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            with f:
+                stat = os.fstat(f.fileno())
+                info = zipfile.ZipInfo(arcname, date_time=time.localtime(stat.st_mtime)[:6])
+                info.file_size = stat.st_size
+                with archive.open(info, mode="w") as entry:
+                    while True:
+                        with timed("file_io"):
+                            chunk = f.read(chunk_size)
+                        if not chunk:
+                            break
+                        entry.write(chunk)
+                        yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+async def stream_zip(
+    entries: Iterable[tuple[str, str]], chunk_size: int = CHUNK_SIZE, read_ahead: int = READ_AHEAD
+) -> AsyncGenerator:
+    """
+    Stream a ZIP archive of the given files, reading at most `read_ahead` chunks ahead of the client.
+    """
+    chunks = iter_zip(entries, chunk_size)
+    queue = asyncio.Queue(maxsize=read_ahead)
+
+    async def produce() -> None:
+        try:
+            while (chunk := await run_in_threadpool(next, chunks, _END)) is not _END:
+                if chunk:
+                    await queue.put(chunk)
+        except Exception:
+            await queue.put(_END)
+            raise
+        await queue.put(_END)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (chunk := await queue.get()) is not _END:
+            yield chunk
+        await producer
+    finally:
+        producer.cancel()
@@ -1,23 +1,147 @@
+import hashlib
 import os
 from uuid import UUID
 
 from config import get_settings
+from database.models import AlbumImages
+from database.models import Albums
+from database.models import AlbumTags
 from database.models import Images
 from database.models import ImageTags
 from database.models import Tags
 from fastapi import HTTPException
 from fastapi import UploadFile
 from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
 from schemas.models import AddTag
+from schemas.models import CreateAlbum
 from schemas.models import ImageMetadata
 from schemas.models import ReplaceTag
+from schemas.models import Tag
 from schemas.models import TagQuery
+from sqlalchemy import cast
+from sqlalchemy import delete
+from sqlalchemy import exists
 from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import literal
 from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Row
 from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from utils import events
+from utils.archive import stream_zip
+from utils.profiling import timed
 
 VALID_MIME_TYPES = ["image/jpeg", "image/jpg", "image/png", "image/gif"]
 
+# Arbitrary key of the advisory lock serializing album creation with tag writes
+ALBUMS_LOCK_ID = 0x616C6275
+
+# Columns of schemas.models.Image and Tag, selected as plain rows by the list endpoints
+IMAGE_COLUMNS = (Images.id, Images.filename, Images.mime_type)
+TAG_COLUMNS = (Tags.id, Tags.name)
+
+
+async def lock_albums(session: AsyncSession, exclusive: bool = False) -> None:
+    """
+    Lock album membership until the end of the transaction, shared by writers of image tags and
+    exclusive when creating an album. Otherwise an album created while an image is tagged would
+    see neither the new tag nor be seen by it, and miss the image for good.
+    """
+    lock = func.pg_advisory_xact_lock if exclusive else func.pg_advisory_xact_lock_shared
+    await session.execute(select(lock(ALBUMS_LOCK_ID)))
+
+
+async def _get_or_create_tag(session: AsyncSession, name: str) -> Tags:
+    """
+    Get or create a tag without writing an existing one. The existing tag is locked FOR KEY SHARE
+    like the foreign key of an association would, so it can not be deleted until this transaction
+    ends, while other writers using the tag are not blocked.
+    """
+    insert_stmt = (
+        pg_insert(Tags)
+        .values(name=name)
+        .on_conflict_do_nothing(index_elements=[Tags.name])
+        .returning(Tags.id, Tags.name)
+    )
+    select_stmt = (
+        select(Tags.id, Tags.name)
+        .where(Tags.name == name)
+        .with_for_update(read=True, key_share=True)
+    )
+    # Retry when the tag is deleted by a concurrent transaction between both statements
+    while True:
+        row = (await session.execute(insert_stmt)).first()
+        if row is None:
+            row = (await session.execute(select_stmt)).first()
+        if row is not None:
+            return Tags(id=row.id, name=row.name)
+
+
+async def _delete_image_tag(session: AsyncSession, image_id: UUID, tag_id: UUID) -> bool:
+    """
+    Delete an association between an image and a tag, and tell if it existed.
+    """
+    stmt = (
+        delete(ImageTags)
+        .where(ImageTags.image_id == image_id, ImageTags.tag_id == tag_id)
+        .returning(ImageTags.tag_id)
+    )
+    result = await session.execute(stmt.execution_options(synchronize_session=False))
+    return result.first() is not None
+
+
+async def _delete_tag_if_unused(session: AsyncSession, tag_id: UUID) -> None:
+    """
+    Delete a tag if no image nor album uses it anymore.
+    """
+    # Wait for other transactions deleting associations with the tag, so the check below sees them
+    stmt = select(Tags.id).where(Tags.id == tag_id)
+    await session.execute(stmt.with_for_update(key_share=True))
+    # A transaction holding the tag FOR KEY SHARE is adding an association with it: keep the tag
+    # rather than waiting, which deadlocks when two transactions swap tags on two images
+    if (await session.execute(stmt.with_for_update(skip_locked=True))).first() is None:
+        return
+    stmt = delete(Tags).where(
+        Tags.id == tag_id,
+        ~exists().where(ImageTags.tag_id == tag_id),
+        ~exists().where(AlbumTags.tag_id == tag_id),
+    )
+    await session.execute(stmt.execution_options(synchronize_session=False))
+
+
+async def _add_image_to_albums(session: AsyncSession, image_id: UUID, tag_id: UUID) -> None:
+    """
+    Add an image to the albums using the tag, if the image now has every tag of the album.
+    The association between the image and the tag must be flushed already.
+    """
+    albums = select(AlbumTags.album_id).where(AlbumTags.tag_id == tag_id)
+    stmt = (
+        select(AlbumTags.album_id, cast(literal(image_id), PG_UUID(as_uuid=True)))
+        .join(ImageTags, ImageTags.tag_id == AlbumTags.tag_id)
+        .join(Albums, Albums.id == AlbumTags.album_id)
+        .where(ImageTags.image_id == image_id, AlbumTags.album_id.in_(albums))
+        .group_by(AlbumTags.album_id, Albums.tag_count)
+        .having(func.count() == Albums.tag_count)
+    )
+    stmt = pg_insert(AlbumImages).from_select(["album_id", "image_id"], stmt)
+    await session.execute(stmt.on_conflict_do_nothing())
+
+
+async def _remove_image_from_albums(session: AsyncSession, image_id: UUID, tag_id: UUID) -> None:
+    """
+    Remove an image from the albums using the tag, after the image lost the tag.
+    """
+    albums = select(AlbumTags.album_id).where(AlbumTags.tag_id == tag_id)
+    stmt = delete(AlbumImages).where(
+        AlbumImages.image_id == image_id, AlbumImages.album_id.in_(albums)
+    )
+    await session.execute(stmt.execution_options(synchronize_session=False))
+
 
 async def create_image_with_upload_file(session: AsyncSession, upload_file: UploadFile) -> Images:
     """
@@ -30,17 +154,31 @@ async def create_image_with_upload_file(session: AsyncSession, upload_file: Uplo
         )
 
     # Save image into database
+    content = await upload_file.read()
+    # Hash off the event loop, large uploads would stall every other request
+    digest = await run_in_threadpool(hashlib.sha256, content)
     image_instance = Images(
-        filename=os.path.basename(upload_file.filename), mime_type=upload_file.content_type
+        filename=os.path.basename(upload_file.filename),
+        mime_type=upload_file.content_type,
+        checksum=digest.hexdigest(),
     )
     session.add(image_instance)
+    await session.flush()
+    await events.log_events(
+        session,
+        events.event(
+            events.IMAGE_CREATED,
+            image_instance.id,
+            filename=image_instance.filename,
+            mime_type=image_instance.mime_type,
+        ),
+    )
     await session.commit()
 
-    # Save image into filesystem based on the image id
-    await session.refresh(image_instance)
+    # Save image into filesystem based on the image id, which is generated client side
     image_local_path = os.path.join(get_settings().uploads_path, str(image_instance.id))
-    with open(image_local_path, "wb") as f:
-        f.write(await upload_file.read())
+    with timed("file_io"), open(image_local_path, "wb") as f:
+        f.write(content)
 
     return image_instance
 
@@ -50,22 +188,28 @@ async def delete_image_by_id(session: AsyncSession, image_id: UUID) -> None:
     Delete an image from the database and filesystem.
     """
     # Delete image from database, and delete orphan tags
+    await lock_albums(session)
     image_instance = await session.get(Images, image_id)
     if image_instance is None:
         raise HTTPException(status_code=404, detail="Image not found")
-    tags = image_instance.tags
-    for tag in tags:
-        stmt = select(ImageTags).where(ImageTags.tag_id == tag.id)
-        result = (await session.execute(stmt)).scalars().all()
-        if len(result) == 1:
-            await session.delete(result[0])
-            await session.delete(tag)
-    await session.delete(image_instance)
+    tags_id = sorted(tag.id for tag in image_instance.tags)
+    for stmt in (
+        delete(AlbumImages).where(AlbumImages.image_id == image_id),
+        delete(ImageTags).where(ImageTags.image_id == image_id),
+        delete(Images).where(Images.id == image_id),
+    ):
+        await session.execute(stmt.execution_options(synchronize_session=False))
+    for tag_id in tags_id:
+        await _delete_tag_if_unused(session, tag_id)
+    await events.log_events(session, events.event(events.IMAGE_DELETED, image_id))
     await session.commit()
 
-    # Delete image from filesystem
+    # Delete image from filesystem, the file may be missing or removed by the scrubber already
     image_local_path = os.path.join(get_settings().uploads_path, str(image_id))
-    os.remove(image_local_path)
+    try:
+        os.remove(image_local_path)
+    except FileNotFoundError:
+        pass
 
 
 async def get_image_response_by_id(session: AsyncSession, image_id: UUID) -> FileResponse:
@@ -79,67 +223,123 @@ async def get_image_response_by_id(session: AsyncSession, image_id: UUID) -> Fil
 
     # Get image from filesystem
     image_local_path = os.path.join(get_settings().uploads_path, str(image_id))
+    if not os.path.isfile(image_local_path):
+        raise HTTPException(status_code=404, detail="Image file not found")
     return FileResponse(image_local_path, media_type=image_instance.mime_type)
 
 
+async def get_archive_response_by_tags(session: AsyncSession, query: TagQuery) -> StreamingResponse:
+    """
+    Stream a ZIP archive of every image matching the tags as a StreamingResponse.
+    """
+    images = await search_image_by_tags(session, query)
+    # The session dependency is closed only after the response is sent, so release the connection
+    # now rather than holding it for the whole download
+    await session.close()
+
+    # Files are read lazily while the response is being sent
+    uploads_path = get_settings().uploads_path
+    entries = [
+        (f"{image.id}-{image.filename}", os.path.join(uploads_path, str(image.id)))
+        for image in images
+    ]
+    return StreamingResponse(
+        stream_zip(entries),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="images.zip"'},
+    )
+
+
 async def get_image_info_by_id(session: AsyncSession, image_id: UUID) -> ImageMetadata:
-    image_instance = await session.get(Images, image_id)
+    metadata = (await get_images_info_by_ids(session, [image_id])).get(image_id)
 
-    if image_instance is None:
+    if metadata is None:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    img_instance = await session.get(Images, image_id)
-    metadata = ImageMetadata(filename=img_instance.filename)
+    return metadata
 
-    for tag_instance in image_instance.tags:
-        metadata.tags.append(tag_instance)
 
-    return metadata
+async def get_images_info_by_ids(
+    session: AsyncSession, image_ids: list[UUID]
+) -> dict[UUID, ImageMetadata]:
+    """
+    Get the metadata of many images in one query, aggregating their tags. Unknown ids are left out.
+    """
+    has_tag = Tags.id.isnot(None)
+    stmt = (
+        select(
+            Images.id,
+            Images.filename,
+            func.array_agg(aggregate_order_by(Tags.id, Tags.name)).filter(has_tag).label("tags_id"),
+            func.array_agg(aggregate_order_by(Tags.name, Tags.name))
+            .filter(has_tag)
+            .label("tags_name"),
+        )
+        .outerjoin(ImageTags, ImageTags.image_id == Images.id)
+        .outerjoin(Tags, Tags.id == ImageTags.tag_id)
+        .where(Images.id.in_(image_ids))
+        .group_by(Images.id)
+    )
+
+    return {
+        row.id: ImageMetadata(
+            filename=row.filename,
+            tags=[
+                Tag(id=tag_id, name=name)
+                for tag_id, name in zip(row.tags_id or [], row.tags_name or [])
+            ],
+        )
+        for row in await session.execute(stmt)
+    }
 
 
-async def search_image_by_tags(session: AsyncSession, query: TagQuery) -> list[Images]:
+async def search_image_by_tags(session: AsyncSession, query: TagQuery) -> list[Row]:
     """
-    Get images from the database based on the tags.
+    Get images from the database based on the tags, as rows of IMAGE_COLUMNS.
     """
     stmt = (
-        select(Images)
+        select(*IMAGE_COLUMNS)
         .join(ImageTags)
         .where(ImageTags.tag_id.in_(query.tags_id))
         .group_by(Images.id)
         .having(func.count(ImageTags.tag_id) == len(query.tags_id))
     )
-    images = (await session.execute(stmt)).scalars().all()
+    images = (await session.execute(stmt)).all()
 
     return images
 
 
-async def list_image_by_limit(session: AsyncSession, offset: int, limit: int) -> list[Images]:
-    stmt = select(Images).offset(offset).limit(limit)
-    return (await session.execute(stmt)).scalars().all()
+async def list_image_by_limit(session: AsyncSession, offset: int, limit: int) -> list[Row]:
+    stmt = select(*IMAGE_COLUMNS).offset(offset).limit(limit)
+    return (await session.execute(stmt)).all()
 
 
 async def add_tag_to_image(session: AsyncSession, image_id: UUID, tag: AddTag) -> Tags:
     """
     Add a tag to the database if tag does not exist and create an association between the image and the tag.
     """
-    # Make sure image exist
-    image_instance = await session.get(Images, image_id)
-    if image_instance is None:
-        raise HTTPException(status_code=404, detail="Image not found")
-
-    # Get or create tag
-    tag_instance = (await session.execute(select(Tags).where(Tags.name == tag.name))).scalar()
-    if tag_instance is None:
-        tag_instance = Tags(name=tag.name)
-        session.add(tag_instance)
-        await session.flush()
+    await lock_albums(session)
+    tag_instance = await _get_or_create_tag(session, tag.name)
 
-    # Create association
-    image_tag_instance = await session.get(ImageTags, (image_id, tag_instance.id))
-    if image_tag_instance is not None:
+    # Create association, only if the image exists
+    stmt = select(Images.id, cast(literal(tag_instance.id), PG_UUID(as_uuid=True))).where(
+        Images.id == image_id
+    )
+    stmt = (
+        pg_insert(ImageTags)
+        .from_select(["image_id", "tag_id"], stmt)
+        .on_conflict_do_nothing()
+        .returning(ImageTags.tag_id)
+    )
+    if (await session.execute(stmt)).first() is None:
+        if await session.get(Images, image_id) is None:
+            raise HTTPException(status_code=404, detail="Image not found")
         raise HTTPException(status_code=400, detail="Image already has this tag")
-    image_tag_instance = ImageTags(image_id=image_id, tag_id=tag_instance.id)
-    session.add(image_tag_instance)
+    await _add_image_to_albums(session, image_id, tag_instance.id)
+    await events.log_events(
+        session,
+        events.event(events.TAG_ADDED, image_id, tag_instance.id, name=tag_instance.name),
+    )
     await session.commit()
 
     return tag_instance
@@ -149,33 +349,32 @@ async def replace_tag_of_image(session: AsyncSession, image_id: UUID, tag: Repla
     """
     Replace the association between an image and a tag with a new tag.
     """
-    # Make sure this association exist
-    image_tag_instance = await session.get(ImageTags, (image_id, tag.id), populate_existing=True)
-    if image_tag_instance is None:
+    # Delete the association, which must exist
+    await lock_albums(session)
+    if not await _delete_image_tag(session, image_id, tag.id):
         raise HTTPException(status_code=404, detail="Image or tag not found")
 
-    # Try to get the tag from the database, if it does not exist, create it
-    tag_instance = (await session.execute(select(Tags).where(Tags.name == tag.name))).scalar()
-    if tag_instance is not None:
-        # If image already has association with the new tag, raise an error
-        if await session.get(ImageTags, (image_id, tag_instance.id)) is not None:
-            raise HTTPException(status_code=400, detail="Image already has this tag")
-    else:
-        tag_instance = Tags(name=tag.name)
-        session.add(tag_instance)
-        await session.flush()
-    await session.delete(image_tag_instance)
-
-    # Create association
-    image_tag_instance = ImageTags(image_id=image_id, tag_id=tag_instance.id)
-    session.add(image_tag_instance)
-    await session.commit()
+    # Create association with the new tag, if image does not have it already
+    tag_instance = await _get_or_create_tag(session, tag.name)
+    stmt = (
+        pg_insert(ImageTags)
+        .values(image_id=image_id, tag_id=tag_instance.id)
+        .on_conflict_do_nothing()
+        .returning(ImageTags.tag_id)
+    )
+    if tag_instance.id == tag.id or (await session.execute(stmt)).first() is None:
+        raise HTTPException(status_code=400, detail="Image already has this tag")
+    await _remove_image_from_albums(session, image_id, tag.id)
+    await _add_image_to_albums(session, image_id, tag_instance.id)
 
     # delete tag if the deleted association is the last one that uses this tag
-    stmt = select(ImageTags).where(ImageTags.tag_id == tag.id)
-    if not (await session.execute(stmt)).scalars().all():
-        await session.delete(await session.get(Tags, tag.id))
-        await session.commit()
+    await _delete_tag_if_unused(session, tag.id)
+    await events.log_events(
+        session,
+        events.event(events.TAG_REMOVED, image_id, tag.id),
+        events.event(events.TAG_ADDED, image_id, tag_instance.id, name=tag_instance.name),
+    )
+    await session.commit()
 
     return tag_instance
 
@@ -184,25 +383,119 @@ async def delete_tag_of_image(session: AsyncSession, image_id: UUID, tag_id: UUI
     """
     Delete an association between an image and a tag.
     """
-    image_tag_instance = await session.get(ImageTags, (image_id, tag_id))
-    if image_tag_instance is None:
+    await lock_albums(session)
+    if not await _delete_image_tag(session, image_id, tag_id):
         raise HTTPException(status_code=404, detail="Image or tag not found")
-
-    await session.delete(image_tag_instance)
-    await session.commit()
+    await _remove_image_from_albums(session, image_id, tag_id)
 
     # delete tag if the deleted association is the last one that uses this tag
-    stmt = select(ImageTags).where(ImageTags.tag_id == tag_id)
-    if not (await session.execute(stmt)).scalars().all():
-        await session.delete(await session.get(Tags, tag_id))
-        await session.commit()
+    await _delete_tag_if_unused(session, tag_id)
+    await events.log_events(session, events.event(events.TAG_REMOVED, image_id, tag_id))
+    await session.commit()
 
 
-async def list_tags(session: AsyncSession) -> list[Tags]:
+async def list_tags(session: AsyncSession) -> list[Row]:
     """
-    Get all tags from the database.
+    Get all tags from the database, as rows of TAG_COLUMNS.
     """
-    stmt = select(Tags)
-    tags = (await session.execute(stmt)).scalars().all()
+    stmt = select(*TAG_COLUMNS)
+    tags = (await session.execute(stmt)).all()
 
     return tags
+
+
+async def create_album(session: AsyncSession, album: CreateAlbum) -> Albums:
+    """
+    Create an album of the images having every tag, and materialize its membership.
+    """
+    tags_id = list(set(album.tags_id))
+    if not tags_id:
+        raise HTTPException(status_code=400, detail="Album needs at least one tag")
+
+    # Wait for concurrent tag writes, and keep the tags from being deleted until the album uses them
+    await lock_albums(session, exclusive=True)
+    stmt = select(Tags.id).where(Tags.id.in_(tags_id)).with_for_update(read=True, key_share=True)
+    if len((await session.execute(stmt)).all()) != len(tags_id):
+        raise HTTPException(status_code=404, detail="Tag not found")
+
+    album_instance = Albums(name=album.name, tag_count=len(tags_id))
+    session.add(album_instance)
+    await session.flush()
+    session.add_all([AlbumTags(album_id=album_instance.id, tag_id=tag_id) for tag_id in tags_id])
+    await session.flush()
+
+    # Same matching as search_image_by_tags, run once
+    stmt = (
+        select(cast(literal(album_instance.id), PG_UUID(as_uuid=True)), ImageTags.image_id)
+        .where(ImageTags.tag_id.in_(tags_id))
+        .group_by(ImageTags.image_id)
+        .having(func.count(ImageTags.tag_id) == len(tags_id))
+    )
+    await session.execute(insert(AlbumImages).from_select(["album_id", "image_id"], stmt))
+    await events.log_events(
+        session,
+        events.event(
+            events.ALBUM_CREATED,
+            album_id=album_instance.id,
+            name=album_instance.name,
+            tags_id=[str(tag_id) for tag_id in sorted(tags_id)],
+        ),
+    )
+    await session.commit()
+
+    return album_instance
+
+
+async def delete_album_by_id(session: AsyncSession, album_id: UUID) -> None:
+    """
+    Delete an album and its membership, and the tags only the album used. Images are kept.
+    """
+    # Wait for concurrent tag writes, which may be adding images to the album
+    await lock_albums(session, exclusive=True)
+    album_instance = await session.get(Albums, album_id)
+    if album_instance is None:
+        raise HTTPException(status_code=404, detail="Album not found")
+    stmt = select(AlbumTags.tag_id).where(AlbumTags.album_id == album_id)
+    tags_id = sorted((await session.execute(stmt)).scalars().all())
+
+    for stmt in (
+        delete(AlbumImages).where(AlbumImages.album_id == album_id),
+        delete(AlbumTags).where(AlbumTags.album_id == album_id),
+    ):
+        await session.execute(stmt.execution_options(synchronize_session=False))
+    await session.delete(album_instance)
+    for tag_id in tags_id:
+        await _delete_tag_if_unused(session, tag_id)
+    await events.log_events(session, events.event(events.ALBUM_DELETED, album_id=album_id))
+    await session.commit()
+
+
+async def list_albums(session: AsyncSession) -> list[Albums]:
+    """
+    Get all albums from the database.
+    """
+    stmt = select(Albums)
+    albums = (await session.execute(stmt)).scalars().all()
+
+    return albums
+
+
+async def list_album_images(
+    session: AsyncSession, album_id: UUID, offset: int, limit: int
+) -> list[Row]:
+    """
+    Get the images of an album from its materialized membership, as rows of IMAGE_COLUMNS.
+    """
+    album_instance = await session.get(Albums, album_id)
+    if album_instance is None:
+        raise HTTPException(status_code=404, detail="Album not found")
+
+    stmt = (
+        select(*IMAGE_COLUMNS)
+        .join(AlbumImages, AlbumImages.image_id == Images.id)
+        .where(AlbumImages.album_id == album_id)
+        .order_by(AlbumImages.image_id)
+        .offset(offset)
+        .limit(limit)
+    )
+    return (await session.execute(stmt)).all()
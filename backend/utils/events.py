@@ -0,0 +1,123 @@
+import asyncio
+import time
+from collections.abc import AsyncGenerator
+from uuid import UUID
+
+import orjson
+from database.connection import get_replica_session_factory
+from database.models import CatalogEvents
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+
+__all__ = [
+    "IMAGE_CREATED",
+    "IMAGE_DELETED",
+    "TAG_ADDED",
+    "TAG_REMOVED",
+    "ALBUM_CREATED",
+    "ALBUM_DELETED",
+    "event",
+    "log_events",
+    "wait_for_events",
+    "stream_events",
+]
+
+IMAGE_CREATED = "image_created"
+IMAGE_DELETED = "image_deleted"
+TAG_ADDED = "tag_added"
+TAG_REMOVED = "tag_removed"
+ALBUM_CREATED = "album_created"
+ALBUM_DELETED = "album_deleted"
+
+# Arbitrary key of the advisory lock serializing writers of the log
+EVENTS_LOCK_ID = 0x63617461
+POLL_INTERVAL = 0.5
+HEARTBEAT_INTERVAL = 15
+MAX_WAIT = 30
+BATCH_SIZE = 100
+
+EVENT_COLUMNS = (
+    CatalogEvents.seq,
+    CatalogEvents.kind,
+    CatalogEvents.image_id,
+    CatalogEvents.tag_id,
+    CatalogEvents.album_id,
+    CatalogEvents.data,
+    CatalogEvents.created_at,
+)
+
+
+def event(
+    kind: str,
+    image_id: UUID | None = None,
+    tag_id: UUID | None = None,
+    album_id: UUID | None = None,
+    **data,
+) -> dict:
+    return {
+        "kind": kind,
+        "image_id": image_id,
+        "tag_id": tag_id,
+        "album_id": album_id,
+        "data": data,
+    }
+
+
+async def log_events(session: AsyncSession, *events: dict) -> None:
+    """
+    Append events to the change log, in the transaction of the change they describe.
+    """
+    if not events:
+        return
+    # Writers hold the lock until commit, so sequence numbers become visible in increasing order
+    # and a consumer never skips an event committed after a later one
+    await session.execute(select(func.pg_advisory_xact_lock(EVENTS_LOCK_ID)))
+    await session.execute(insert(CatalogEvents), list(events))
+
+
+async def read_events(after: int, limit: int) -> list[Row]:
+    async with get_replica_session_factory()() as session:
+        stmt = (
+            select(*EVENT_COLUMNS)
+            .where(CatalogEvents.seq > after)
+            .order_by(CatalogEvents.seq)
+            .limit(limit)
+        )
+        return (await session.execute(stmt)).all()
+
+
+async def wait_for_events(after: int, limit: int, wait: float) -> list[Row]:
+    """
+    Get at most `limit` events after the cursor, waiting up to `wait` seconds for one if there are
+    none yet. A session is only held while polling, not while waiting.
+    """
+    limit = max(1, min(limit, BATCH_SIZE))
+    deadline = time.monotonic() + min(wait, MAX_WAIT)
+    while not (events := await read_events(after, limit)) and time.monotonic() < deadline:
+        await asyncio.sleep(POLL_INTERVAL)
+    return events
+
+
+async def stream_events(after: int) -> AsyncGenerator:
+    """
+    Stream the events after the cursor as Server-Sent Events, forever. The event id is the
+    sequence number, so a reconnecting client resumes with the Last-Event-ID header.
+    """
+    last_sent = time.monotonic()
+    while True:
+        events = await read_events(after, BATCH_SIZE)
+        for row in events:
+            yield f"id: {row.seq}\nevent: {row.kind}\ndata: ".encode()
+            yield orjson.dumps(row._asdict()) + b"\n\n"
+            after = row.seq
+        if events:
+            last_sent = time.monotonic()
+            continue
+        if time.monotonic() - last_sent >= HEARTBEAT_INTERVAL:
+            # Comment line keeping idle connections open through proxies
+            yield b": heartbeat\n\n"
+            last_sent = time.monotonic()
+        await asyncio.sleep(POLL_INTERVAL)
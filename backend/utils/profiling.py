@@ -0,0 +1,209 @@
+import asyncio
+import hmac
+import json
+import logging
+import random
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from dataclasses import field
+
+from config import get_settings
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import Headers
+from starlette.datastructures import MutableHeaders
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+__all__ = ["ProfiledRoute", "ProfilingMiddleware", "install_query_hooks", "timed"]
+
+CALLGRAPH = "callgraph"
+
+logger = logging.getLogger("profiling")
+slow_query_logger = logging.getLogger("profiling.slow_query")
+
+
+@dataclass
+class RequestProfile:
+    timings: dict[str, float] = field(default_factory=dict)
+    statements: list[dict] = field(default_factory=list)
+
+    def add(self, section: str, duration: float) -> None:
+        self.timings[section] = self.timings.get(section, 0.0) + duration
+
+    def breakdown(self) -> dict[str, float]:
+        """
+        Get the time spent in each section, in milliseconds.
+        """
+        timings = dict(self.timings)
+        if "serialization" in timings and "endpoint" in timings:
+            # Endpoints returning an encoded response time their serialization explicitly
+            timings["endpoint"] -= timings["serialization"]
+        if "handler" in timings:
+            # Everything in the route handler outside the endpoint: validation and serialization
+            timings["serialization"] = (
+                timings.get("serialization", 0.0)
+                + timings.pop("handler")
+                - self.timings.get("endpoint", 0.0)
+            )
+        return {section: round(duration * 1000, 3) for section, duration in timings.items()}
+
+
+_current_profile: ContextVar[RequestProfile | None] = ContextVar("current_profile", default=None)
+
+
+@contextmanager
+def timed(section: str):
+    """
+    Add the time spent in the block to a section of the current request profile, if any.
+    """
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(section, time.perf_counter() - start)
+
+
+def install_query_hooks(engine: AsyncEngine) -> None:
+    """
+    Time every statement of the engine, recording it in the current request profile and logging it
+    when slower than the configured threshold.
+    """
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["query_start_time"].pop()
+        record = {
+            "duration_ms": round(duration * 1000, 3),
+            "statement": statement,
+            "parameters": parameters,
+        }
+
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.add("db", duration)
+            profile.statements.append(record)
+
+        if record["duration_ms"] >= get_settings().slow_query_ms:
+            slow_query_logger.warning(json.dumps(record, default=str))
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def handle_error(context):
+        # after_cursor_execute does not run for failed statements, drop their start time here
+        if context.connection is not None and context.connection.info.get("query_start_time"):
+            context.connection.info["query_start_time"].pop()
+
+
+class ProfiledRoute(APIRoute):
+    """
+    Route telling apart the time spent in the endpoint from the time spent around it.
+    """
+
+    def get_route_handler(self) -> Callable:
+        call = self.dependant.call
+        if asyncio.iscoroutinefunction(call):
+
+            async def endpoint(**kwargs):
+                with timed("endpoint"):
+                    return await call(**kwargs)
+
+            self.dependant.call = endpoint
+
+        handler = super().get_route_handler()
+
+        async def profiled_handler(request):
+            with timed("handler"):
+                return await handler(request)
+
+        return profiled_handler
+
+
+class ProfilingMiddleware:
+    """
+    Profile requests sent with the profiling header carrying the configured token, and a sample of
+    the others. The breakdown is logged with the statements, and returned in the Server-Timing
+    header to requests sent with the token. Sending "<token> callgraph" also logs a call profile,
+    when pyinstrument is installed.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self.header = get_settings().profile_header
+        self.sample_rate = get_settings().profile_sample_rate
+        if not logger.handlers:
+            # uvicorn only configures its own loggers, the profiles would be dropped otherwise
+            logger.addHandler(logging.StreamHandler())
+            logger.setLevel(logging.INFO)
+
+    def requested_mode(self, value: str | None) -> str | None:
+        """
+        Get the mode requested by a profiling header value, if it carries the configured token.
+        """
+        token = get_settings().profile_token
+        if value is None or not token:
+            return None
+        given, _, mode = value.partition(" ")
+        if not hmac.compare_digest(given.encode(), token.encode()):
+            return None
+        return mode
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        requested = self.requested_mode(Headers(scope=scope).get(self.header))
+        if requested is None and random.random() >= self.sample_rate:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile()
+        token = _current_profile.set(profile)
+        profiler = None
+        if requested == CALLGRAPH and Profiler is not None:
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+
+        async def send_with_timing(message) -> None:
+            if (
+                message["type"] == "http.response.start"
+                and requested is not None
+                and profile.timings
+            ):
+                timing = ", ".join(
+                    f"{section};dur={duration}" for section, duration in profile.breakdown().items()
+                )
+                MutableHeaders(scope=message).append("Server-Timing", timing)
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            profile.add("total", time.perf_counter() - start)
+            _current_profile.reset(token)
+            record = {
+                "method": scope["method"],
+                "path": scope["path"],
+                "timings_ms": profile.breakdown(),
+                "statements": profile.statements,
+            }
+            if profiler is not None:
+                profiler.stop()
+                record["callgraph"] = profiler.output_text()
+            logger.info(json.dumps(record, default=str))
@@ -0,0 +1,177 @@
+import argparse
+import asyncio
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from config import get_settings
+from database.connection import get_session_factory
+from database.models import AlbumImages
+from database.models import AlbumTags
+from database.models import Images
+from database.models import ImageTags
+from database.models import Tags
+from schemas.models import StorageReport
+from sqlalchemy import bindparam
+from sqlalchemy import delete
+from sqlalchemy import exists
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from utils import events
+from utils.crud import lock_albums
+
+__all__ = ["scrub_storage"]
+
+BATCH_SIZE = 1000
+WORKERS = min(8, os.cpu_count() or 1)
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def scan_uploads(uploads_path: str) -> set[str]:
+    """
+    Get the names of all regular files in the uploads directory.
+    """
+    with os.scandir(uploads_path) as entries:
+        return {entry.name for entry in entries if entry.is_file(follow_symlinks=False)}
+
+
+def sha256_file(path: str) -> str | None:
+    """
+    Get the sha256 hex digest of a file, or None if it has disappeared.
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+async def _delete_images(session: AsyncSession, image_ids: list) -> list:
+    """
+    Delete image rows, their tag and album associations and the tags left unused.
+    Return the ids of the rows deleted, leaving out those deleted concurrently.
+    """
+    await lock_albums(session)
+    deleted = []
+    for i in range(0, len(image_ids), BATCH_SIZE):
+        batch = image_ids[i : i + BATCH_SIZE]
+        for stmt in (
+            delete(AlbumImages).where(AlbumImages.image_id.in_(batch)),
+            delete(ImageTags).where(ImageTags.image_id.in_(batch)),
+        ):
+            await session.execute(stmt.execution_options(synchronize_session=False))
+        stmt = delete(Images).where(Images.id.in_(batch)).returning(Images.id)
+        result = await session.execute(stmt.execution_options(synchronize_session=False))
+        deleted.extend(result.scalars().all())
+    stmt = delete(Tags).where(
+        ~exists().where(ImageTags.tag_id == Tags.id), ~exists().where(AlbumTags.tag_id == Tags.id)
+    )
+    await session.execute(stmt.execution_options(synchronize_session=False))
+    return deleted
+
+
+async def _backfill_checksums(session: AsyncSession, checksums: list[dict]) -> None:
+    table = Images.__table__
+    stmt = (
+        update(table)
+        .where(table.c.id == bindparam("image_id"))
+        .values(checksum=bindparam("new_checksum"))
+    )
+    for i in range(0, len(checksums), BATCH_SIZE):
+        await session.execute(stmt, checksums[i : i + BATCH_SIZE])
+
+
+async def scrub_storage(
+    session: AsyncSession, repair: bool = False, verify: bool = True
+) -> StorageReport:
+    """
+    Compare the uploads directory with the images table and report rows without a file, files
+    without a row and files whose content does not match the stored checksum.
+    With repair, rows without a file and files without a row are deleted and missing checksums
+    are backfilled. Corrupt files are only reported.
+    """
+    uploads_path = get_settings().uploads_path
+    report = StorageReport(repaired=repair)
+
+    # List the directory before reading the table, so a file always has its row committed already
+    files = await run_in_threadpool(scan_uploads, uploads_path)
+    report.scanned_files = len(files)
+
+    # Stream the table in batches and hash the matching files in parallel
+    backfill = []
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        result = await session.stream(select(Images.id, Images.checksum))
+        async for batch in result.partitions(BATCH_SIZE):
+            report.scanned_images += len(batch)
+            present = []
+            for image_id, checksum in batch:
+                if str(image_id) in files:
+                    files.discard(str(image_id))
+                    present.append((image_id, checksum))
+                else:
+                    report.missing_files.append(image_id)
+            if not verify:
+                continue
+
+            digests = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        executor, sha256_file, os.path.join(uploads_path, str(image_id))
+                    )
+                    for image_id, _ in present
+                )
+            )
+            for (image_id, checksum), digest in zip(present, digests):
+                if digest is None:
+                    report.missing_files.append(image_id)
+                elif checksum is None:
+                    backfill.append({"image_id": image_id, "new_checksum": digest})
+                elif checksum != digest:
+                    report.corrupt_files.append(image_id)
+    report.orphan_files = sorted(files)
+
+    if not repair:
+        return report
+
+    # Uploads commit the row before writing the file, so skip files that have appeared since
+    missing = [
+        image_id
+        for image_id in report.missing_files
+        if not os.path.exists(os.path.join(uploads_path, str(image_id)))
+    ]
+    deleted = await _delete_images(session, missing)
+    await _backfill_checksums(session, backfill)
+    # Last, so the lock of the event log is held as briefly as possible
+    await events.log_events(
+        session, *(events.event(events.IMAGE_DELETED, image_id) for image_id in deleted)
+    )
+    await session.commit()
+
+    for name in report.orphan_files:
+        try:
+            os.remove(os.path.join(uploads_path, name))
+        except FileNotFoundError:
+            pass
+
+    return report
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Check uploaded files against the database.")
+    parser.add_argument("--repair", action="store_true", help="fix mismatches instead of reporting")
+    parser.add_argument("--no-verify", action="store_true", help="skip content checksums")
+    args = parser.parse_args()
+
+    async with get_session_factory()() as session:
+        report = await scrub_storage(session, repair=args.repair, verify=not args.no_verify)
+    print(report.json(indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())